@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
 import argparse
+import heapq
+import json
+import multiprocessing
 import os
+import pickle
 import re
 import sys
 import xml.etree.ElementTree as ET
@@ -23,10 +27,20 @@ parser = argparse.ArgumentParser()
 
 parser.add_argument('-v', '--verbose', action='store_true', dest='verbose')
 parser.add_argument('-I', '--include', action='store', dest='includedir')
+parser.add_argument('--include-cache', action='store', dest='includecache')
+parser.add_argument('--snapshot', action='store', dest='snapshot')
+parser.add_argument('--link', action='store_true', dest='link')
+parser.add_argument('-j', '--jobs', action='store', dest='jobs', type=int, default=1)
+parser.add_argument('--dedup', action='store_true', dest='dedup')
+parser.add_argument('--factor', action='store_true', dest='factor')
+parser.add_argument('--compact', action='store_true', dest='compact')
 parser.add_argument('input')
 
 args = parser.parse_args()
 
+if args.link and not args.snapshot:
+    parser.error('--link requires --snapshot')
+
 if args.includedir:
     includedir = args.includedir
 
@@ -41,6 +55,16 @@ inputevents = { }
 
 included = { }
 
+includeindexes = { }
+
+resolvedincludes = { }
+
+deferred = None
+
+parallelcontainers = [ ]
+
+INCLUDECACHEVERSION = 1
+
 def verbose(indent, string):
     if args.verbose:
         s = ''
@@ -65,6 +89,120 @@ def cleanpathname(path):
     result = result.replace('//', '/')
     return result
 
+# The Include elements in the ModelBehaviorDefs files refer to files
+# using whatever case the author happened to type, which often does
+# not match the case of the actual file names. That works on Windows,
+# but not on a case-sensitive file system. So scan each include root
+# once into an index keyed by the lowercased path relative to the
+# root, and look up the included files from that. Optionally the index
+# is persisted so that it does not have to be rebuilt on each run.
+
+def scanincluderoot(root):
+    dirs = { }
+    files = { }
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        reldir = cleanpathname(os.path.relpath(dirpath, root))
+        dirs[reldir] = os.stat(dirpath).st_mtime_ns
+        for filename in sorted(filenames):
+            relpath = cleanpathname(os.path.normpath(os.path.join(reldir, filename)))
+            files.setdefault(relpath.lower(), []).append(relpath)
+    return { 'version': INCLUDECACHEVERSION, 'root': root, 'dirs': dirs, 'files': files }
+
+def loadincludecache(root, cachefile):
+    try:
+        with open(cachefile, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != INCLUDECACHEVERSION or index.get('root') != root:
+        return None
+    if not includedirsunchanged(root, index['dirs']):
+        return None
+    return index
+
+def includedirsunchanged(root, dirs):
+    # Adding, removing, or renaming a file or directory changes the
+    # modification time of the directory containing it, so checking
+    # the directories is enough.
+    for reldir, mtime in dirs.items():
+        try:
+            if os.stat(os.path.join(root, reldir)).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def saveincludecache(index, cachefile):
+    with open(cachefile, 'w') as f:
+        json.dump(index, f)
+
+def includeindex(root):
+    index = includeindexes.get(root)
+    if index != None:
+        return index
+    if args.includecache:
+        index = loadincludecache(root, args.includecache)
+        if index != None:
+            verbose(0, 'Loaded index of "' + root + '" from "' + args.includecache + '"')
+    if index == None:
+        index = scanincluderoot(root)
+        verbose(0, 'Indexed ' + str(sum([len(v) for v in index['files'].values()])) + ' files in "' + root + '"')
+        if args.includecache:
+            saveincludecache(index, args.includecache)
+    includeindexes[root] = index
+    return index
+
+def resolveinclude(root, relpath):
+    # References with a leading separator are relative to the root, too
+    relpath = cleanpathname(os.path.normpath(cleanpathname(relpath).lstrip('/')))
+    if relpath == '..' or relpath.startswith('../') or os.path.isabs(relpath):
+        return None
+    candidates = includeindex(root)['files'].get(relpath.lower())
+    if not candidates:
+        return None
+    if len(candidates) > 1:
+        if not relpath in candidates:
+            fatal('Ambiguous include "' + relpath + '" matches "' + '", "'.join(candidates) + '" in "' + root + '"')
+        verbose(0, 'Include "' + relpath + '" also matches "' + '", "'.join(candidates) + '", using exact match')
+        return root + '/' + relpath
+    return root + '/' + candidates[0]
+
+def findinclude(kid, currentfile):
+    key = (currentfile, kid.get('ModelBehaviorFile'), kid.get('Path'), kid.get('RelativeFile'))
+    fullname = resolvedincludes.get(key)
+    if fullname == None:
+        fullname = locateinclude(kid, currentfile)
+        resolvedincludes[key] = fullname
+    return fullname
+
+def locateinclude(kid, currentfile):
+    root = cleanpathname(os.path.abspath(includedir))
+    filename = kid.get('ModelBehaviorFile')
+    if filename == None:
+        filename = kid.get('Path')
+    if filename:
+        filename = cleanpathname(filename)
+        fullname = resolveinclude(root, filename)
+        if fullname == None:
+            fatal('Included file "' + filename + '" not found in "' + root + '"')
+        return fullname
+    filename = kid.get('RelativeFile')
+    if not filename:
+        fatal('"Include" element without "ModelBehaviorFile", "Path", or "RelativeFile" attribute');
+    filename = cleanpathname(filename)
+    target = cleanpathname(os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(currentfile)), filename)))
+    # A relative include from a file in the include root is looked up
+    # in the index, too. Other files (typically the aircraft's own
+    # ones) are used as such.
+    if target.startswith(root + '/'):
+        fullname = resolveinclude(root, target[len(root) + 1:])
+        if fullname != None:
+            return fullname
+    elif os.path.isfile(target):
+        return target
+    fatal('Included file "' + filename + '" relative to "' + currentfile + '" not found')
+
 def treetostring(depth, compress, elem):
     result = '<' + elem.tag;
     for i in elem.keys():
@@ -83,11 +221,12 @@ def treetostring(depth, compress, elem):
     else:
         for i in list(elem):
             result += treetostring(depth - 1, compress, i)
-            lasttail = list(elem)[-1].tail
-            if compress:
-                result += re.sub(r'\s+', ' ', lasttail)
+            if i.tail == None:
+                pass
+            elif compress:
+                result += re.sub(r'\s+', ' ', i.tail)
             else:
-                result += lasttail
+                result += i.tail
     result += '</' + elem.tag + '>'
     return result
 
@@ -457,6 +596,181 @@ def expandswitch(siblings, ix, indent, params):
             siblings.insert(ix, i)
             ix += 1
 
+# Loops in generated templates often iterate dozens of times, so the
+# Do body is analysed once after the first iteration. A child of the
+# Do element that does not refer to the loop variable, neither itself
+# nor in the templates it can call, expands the same on each
+# iteration. It is expanded once, including the template calls,
+# conditions, and switches in it, and the result is reused. Other
+# children without such elements are expanded once with the loop
+# variable bound to a placeholder, which is then replaced on each
+# iteration. The rest are still expanded on each iteration. If any of
+# the children can define something, nothing is hoisted.
+
+LOOPVARPLACEHOLDER = '\x00LOOPVAR\x00'
+
+ACTIVETAGS = { 'FILE', 'EOF', 'Include', 'Template', 'InputEvent', 'Condition', 'Switch', 'Loop', 'UseTemplate',
+               'Parameters', 'DefaultTemplateParameters', 'EditableTemplateParameters', 'OverrideTemplateParameters' }
+
+# Elements that can modify the parameters of the loop itself
+MUTATINGTAGS = { 'Include', 'Loop',
+                 'Parameters', 'DefaultTemplateParameters', 'EditableTemplateParameters', 'OverrideTemplateParameters' }
+
+def hasdescendant(elem, tags):
+    for i in elem.iter():
+        if i is not elem and i.tag in tags:
+            return True
+    return False
+
+def hasplaceholder(elem):
+    if LOOPVARPLACEHOLDER in elem.tag \
+       or (elem.text != None and LOOPVARPLACEHOLDER in elem.text) \
+       or (elem.tail != None and LOOPVARPLACEHOLDER in elem.tail):
+        return True
+    for value in elem.attrib.values():
+        if value != None and LOOPVARPLACEHOLDER in value:
+            return True
+    return False
+
+def placeholdernodes(elem, nodes):
+    # Collect the elements whose subtree refers to the loop variable
+    result = hasplaceholder(elem)
+    for kid in elem:
+        if placeholdernodes(kid, nodes):
+            result = True
+    if result:
+        nodes.add(id(elem))
+    return result
+
+def loopclosure(elem, var, params):
+    # The element and the bodies of the templates it can call. The
+    # loop variable can have any value.
+    params = params.copy()
+    params[var] = '__HASH__' + var + '__HSAH__'
+    templatenames, inputeventids = reachabledefinitions(elem, { 'templates': templates, 'inputevents': inputevents }, params)
+    return [ elem ] + [templates[name] for name in templatenames]
+
+def refersto(elems, var):
+    marker = '__HASH__' + var + '__HSAH__'
+    # The name can also be used as such in Check attributes, Value
+    # elements, and so on
+    name = re.compile('(?<![_A-Za-z0-9])' + re.escape(var) + '(?![_A-Za-z0-9])')
+    for root in elems:
+        for elem in root.iter():
+            if elem.tag == var or elem.tag.find(marker) != -1:
+                return True
+            for string in [ elem.text, elem.tail ] + list(elem.attrib.values()):
+                if string != None and (string.find(marker) != -1 or name.search(string)):
+                    return True
+    return False
+
+def analyseloopbody(intemplate, do, var, indent, file, params):
+    if intemplate and hasdescendant(do, MUTATINGTAGS):
+        return None
+    for value in params.values():
+        if value.find('__HASH__') != -1:
+            return None
+    closures = [ ]
+    for i in list(do):
+        closure = loopclosure(i, var, params)
+        for elem in closure:
+            if hasdescendant(elem, DEFININGTAGS):
+                return None
+        closures.append(closure)
+    placeholderparams = params.copy()
+    placeholderparams[var] = LOOPVARPLACEHOLDER
+    body = []
+    for i, closure in zip(list(do), closures):
+        if not refersto(closure, var):
+            # Expand the child, and then as the loop's caller would
+            # expand what the loop produces
+            i = expand(intemplate, shallowcopyelement(i), indent, file, params)
+            i.text = expandstring(i.text, params)
+            i.tail = expandstring(i.tail, params)
+            expansion = list(expandtomany(intemplate, shallowcopyelement(i), indent, file, params))
+            body.append(('hoisted', (i, expansion)))
+            continue
+        if hasdescendant(i, ACTIVETAGS):
+            body.append(('active', i))
+            continue
+        i = expand(intemplate, shallowcopyelement(i), indent, file, placeholderparams)
+        i.text = expandstring(i.text, placeholderparams)
+        i.tail = expandstring(i.tail, placeholderparams)
+        nodes = set()
+        if placeholdernodes(i, nodes):
+            body.append(('variant', (i, nodes)))
+        else:
+            body.append(('invariant', i))
+    verbose(indent, ' Loop body: ' + ', '.join([kind for kind, i in body]))
+    return body
+
+def substituteloopvar(elem, nodes, value):
+    # Share the subtrees that do not refer to the loop variable
+    if not id(elem) in nodes:
+        return elem
+    result = ET.Element(elem.tag.replace(LOOPVARPLACEHOLDER, value))
+    for key, attrib in elem.items():
+        if attrib != None:
+            attrib = attrib.replace(LOOPVARPLACEHOLDER, value)
+        result.set(key, attrib)
+    if elem.text != None:
+        result.text = elem.text.replace(LOOPVARPLACEHOLDER, value)
+    if elem.tail != None:
+        result.tail = elem.tail.replace(LOOPVARPLACEHOLDER, value)
+    for kid in elem:
+        result.append(substituteloopvar(kid, nodes, value))
+    return result
+
+# Compile the While condition of a loop into a Python function of the
+# loop variable and the parameters. Only comparisons of values and
+# constants are handled, anything else is left to evalexpr().
+
+COMPARISONS = {
+    'Greater': lambda a, b: a > b,
+    'Lower': lambda a, b: a < b,
+    'GreaterOrEqual': lambda a, b: a >= b,
+    'LowerOrEqual': lambda a, b: a <= b,
+    'Equal': lambda a, b: a == b,
+    'StringEqual': lambda a, b: a == b,
+}
+
+def compileoperand(elem, var, numeric):
+    if len(elem) != 0:
+        return None
+    if elem.tag == 'Value':
+        name = elem.text
+        if name == var:
+            if numeric:
+                return lambda loopvar, params: loopvar
+            return lambda loopvar, params: params[var]
+        def value(loopvar, params):
+            result = params.get(name)
+            if result == None:
+                result = '0'
+            if numeric:
+                return float(result)
+            return result
+        return value
+    elif elem.tag == 'Number' or elem.tag == 'Text':
+        constant = elem.text
+        if numeric:
+            try:
+                constant = float(constant)
+            except (TypeError, ValueError):
+                return None
+        return lambda loopvar, params: constant
+    return None
+
+def compilewhile(elem, var, indent):
+    comparison = COMPARISONS.get(elem.tag)
+    if comparison != None and len(elem) == 2:
+        numeric = elem.tag != 'StringEqual'
+        a = compileoperand(elem[0], var, numeric)
+        b = compileoperand(elem[1], var, numeric)
+        if a != None and b != None:
+            return lambda loopvar, params: comparison(a(loopvar, params), b(loopvar, params))
+    return lambda loopvar, params: evalexpr(elem, indent, params) != 'False'
+
 def expandloop(intemplate, siblings, ix, indent, file, params):
     elem = siblings[ix]
     if not intemplate:
@@ -510,18 +824,42 @@ def expandloop(intemplate, siblings, ix, indent, file, params):
     params[var] = str(loopvar)
     numiters = 0
 
+    if hwile != None:
+        hwile = compilewhile(list(hwile)[0], var, indent)
+    body = None
+
     siblings.pop(ix)
     while True:
         # The While test is checked before each iteration
         if hwile != None:
-            if evalexpr(list(hwile)[0], indent, params) == 'False':
+            if not hwile(loopvar, params):
                 break
-        for i in list(do):
-            i = expand(intemplate, shallowcopyelement(i), indent, file, params)
-            i.text = expandstring(i.text, params)
-            i.tail = expandstring(i.tail, params)
-            siblings.insert(ix, i)
-            ix += 1
+        if numiters == 1:
+            body = analyseloopbody(intemplate, do, var, indent, file, params)
+        if body == None:
+            for i in list(do):
+                i = expand(intemplate, shallowcopyelement(i), indent, file, params)
+                i.text = expandstring(i.text, params)
+                i.tail = expandstring(i.tail, params)
+                siblings.insert(ix, i)
+                ix += 1
+        else:
+            for kind, i in body:
+                if kind == 'hoisted':
+                    for j in i[1]:
+                        siblings.insert(ix, shallowcopyelement(j))
+                        ix += 1
+                    continue
+                if kind == 'invariant':
+                    i = shallowcopyelement(i)
+                elif kind == 'variant':
+                    i = substituteloopvar(i[0], i[1], params[var])
+                else:
+                    i = expand(intemplate, shallowcopyelement(i), indent, file, params)
+                    i.text = expandstring(i.text, params)
+                    i.tail = expandstring(i.tail, params)
+                siblings.insert(ix, i)
+                ix += 1
         numiters += 1
         if to == None and numiters == 64:
             break
@@ -529,6 +867,16 @@ def expandloop(intemplate, siblings, ix, indent, file, params):
             break
         loopvar += inc
         params[var] = str(loopvar)
+    if body != None and len(body) > 0 and body[-1][0] == 'hoisted':
+        # The last element produced by the loop gets the tail of the
+        # Loop element, which the caller then handles when it expands
+        # that element. So put the unexpanded child back in its place.
+        i, expansion = body[-1][1]
+        ix -= len(expansion)
+        for j in expansion:
+            siblings.pop(ix)
+        siblings.insert(ix, shallowcopyelement(i))
+        ix += 1
     if then != None:
         for i in list(then):
             i = shallowcopyelement(i)
@@ -658,25 +1006,11 @@ def expand(intemplate, elem, indent, file, params):
             filestack.pop()
             kids.pop(ix)
         elif kid.tag == 'Include':
-            filename = kid.get('ModelBehaviorFile')
-            if filename == None:
-                filename = kid.get('Path')
-            if filename:
-                filename = cleanpathname(filename)
-                fullname = includedir + '/' + filename
-            else:
-                filename = kid.get('RelativeFile')
-                if filename:
-                    filename = cleanpathname(filename)
-                    fullname = os.path.dirname(filestack[-1]) + '/' + filename
-                else:
-                    fatal('"Include" element without "ModelBehaviorFile", "Path", or "RelativeFile" attribute');
+            fullname = findinclude(kid, filestack[-1])
 
             kids.pop(ix)
 
-            if included.get(fullname.lower()):
-                ix -= 1
-            else:
+            if not included.get(fullname):
                 addix = ix
                 includedtree = parse(fullname)
                 kids.insert(addix, filemarker(fullname))
@@ -690,7 +1024,7 @@ def expand(intemplate, elem, indent, file, params):
                 addix += 1
                 kids.insert(addix, filemarker(filestack[-1]))
                 addix += 1
-                included[fullname.lower()] = True
+                included[fullname] = True
                 verbose(indent, 'Included file "' + fullname + '"')
         elif kid.tag == 'Template':
             name = kid.get('Name')
@@ -716,6 +1050,11 @@ def expand(intemplate, elem, indent, file, params):
             expandswitch(kids, ix, indent, params)
         elif kid.tag == 'Loop':
             expandloop(intemplate, kids, ix, indent, file, params)
+        elif deferred != None and (kid.tag == 'Component' or kid.tag == 'UseTemplate') \
+             and isparallelcontainer(intemplate, elem) and isindependent(kids[ix]):
+            verbose(indent, ' Deferring ' + elemtostring(kids[ix]) + ' for parallel expansion')
+            deferred.append((elem, kids[ix], len(templates), filestack[-1], params.copy()))
+            ix += 1
         elif kid.tag == 'UseTemplate':
             expandusetemplate(kids, ix, indent + 1, filestack[-1], params)
         elif intemplate \
@@ -725,6 +1064,8 @@ def expand(intemplate, elem, indent, file, params):
                   or kid.tag == 'OverrideTemplateParameters'):
             expandparameters(kids, ix, indent + 1, file, params)
         else:
+            if deferred != None and elem is tree and kid.tag == 'Behaviors':
+                parallelcontainers.append(kid)
             kids[ix] = expand(intemplate, kid, indent + 1, filestack[-1], params)
             kids[ix].text = expandstring(kid.text, params)
             kids[ix].tail = expandstring(kid.tail, params)
@@ -743,11 +1084,529 @@ def expandtomany(intemplate, elem, indent, file, params):
     dummy.append(elem)
     return expand(intemplate, dummy, indent, file, params)
 
+# Prelinked snapshots. Only a fraction of the templates in the
+# ModelBehaviorDefs tree is used by a given model file. Linking walks
+# the includes of the input file once, finds the templates and input
+# events reachable from it, and saves just those, already parsed, in a
+# snapshot file. Later runs on the same input file load the snapshot
+# instead of the included files, as long as none of the source files
+# have changed.
+
+SNAPSHOTVERSION = 2
+
+def collectdefinitions(elem, file, toplevel, defs):
+    for kid in list(elem):
+        if kid.tag == 'Include':
+            fullname = findinclude(kid, file)
+            if defs['files'].get(fullname) == None:
+                defs['files'][fullname] = os.stat(fullname).st_mtime_ns
+                verbose(1, 'Linking "' + fullname + '"')
+                collectdefinitions(parse(fullname), fullname, True, defs)
+        elif kid.tag == 'Template' or kid.tag == 'InputEvent':
+            # The definitions in the input file itself are handled when
+            # it is expanded
+            if file == args.input:
+                continue
+            if not toplevel:
+                defs['other'].append(file)
+                continue
+            kid = shallowcopyelement(kid)
+            for i in kid.keys():
+                kid.set(i, expandstring(kid.get(i), { }))
+            if kid.tag == 'Template':
+                name = kid.get('Name')
+                if not name:
+                    fatal('No Name attribute in "Template" element')
+                if defs['templates'].get(name) != None:
+                    fatal('Multiply defined template "' + name + '"')
+                defs['templates'][name] = kid
+            else:
+                id = kid.get('ID')
+                if not id:
+                    fatal('No ID attribute in "InputEvent" element')
+                if defs['inputevents'].get(id) != None:
+                    fatal('Multiply defined input event "' + id + '"')
+                defs['inputevents'][id] = kid
+        elif file == args.input:
+            collectdefinitions(kid, file, False, defs)
+        else:
+            # Anything else in an included file ends up in the output,
+            # so such files can not be linked.
+            defs['other'].append(file)
+
+def collectparamvalues(elems):
+    # The possible values of each parameter, or None if it can have
+    # any value. Any parameter can be unset, and thus empty, on some
+    # path, for instance when it is set only under a Condition.
+    values = { }
+    for root in elems:
+        for elem in root.iter():
+            if elem.tag.find('__HASH__') != -1:
+                return None
+            if elem.tag == 'Setup' and elem.find('Param') != None:
+                values[elem.find('Param').text] = None
+            if not elem.tag in values:
+                values[elem.tag] = { '' }
+            if values[elem.tag] == None:
+                continue
+            text = elem.text
+            if text == None:
+                text = ''
+            if elem.get('Process') != None or text.find('__HASH__') != -1:
+                values[elem.tag] = None
+            else:
+                values[elem.tag].add(text)
+    return values
+
+def namepattern(name, values):
+    parts = re.split('__HASH__(' + IDENTIFIER + ')__HSAH__', name)
+    pattern = ''
+    for i in range(len(parts)):
+        if i % 2 == 0:
+            pattern += re.escape(parts[i])
+        elif values == None or values.get(parts[i], { '' }) == None:
+            pattern += '.*'
+        else:
+            pattern += '(?:' + '|'.join([re.escape(v) for v in sorted(values.get(parts[i], { '' }))]) + ')'
+    return re.compile(pattern, re.DOTALL)
+
+MAXEXPANDEDNAMES = 256
+
+def expandednames(name, values):
+    # All the names that a dynamic name can expand to, or None if it
+    # can expand to anything or to too many names
+    parts = re.split('__HASH__(' + IDENTIFIER + ')__HSAH__', name)
+    names = [ '' ]
+    for i in range(len(parts)):
+        if i % 2 == 0:
+            names = [n + parts[i] for n in names]
+        elif values == None or values.get(parts[i], { '' }) == None:
+            return None
+        else:
+            names = [n + v for n in names for v in values.get(parts[i], { '' })]
+            if len(names) > MAXEXPANDEDNAMES:
+                return None
+    return names
+
+def reachablenames(elems, tag, attrib, candidates, values, result):
+    for root in elems:
+        for elem in root.iter(tag):
+            name = elem.get(attrib)
+            if name == None:
+                continue
+            if name.find('__HASH__') == -1:
+                if name in candidates:
+                    result.add(name)
+                continue
+            names = expandednames(name, values)
+            if names != None:
+                for candidate in names:
+                    if candidate in candidates:
+                        result.add(candidate)
+                continue
+            pattern = namepattern(name, values)
+            for candidate in candidates:
+                if pattern.fullmatch(candidate):
+                    result.add(candidate)
+
+def addparamvalues(values, params):
+    if values == None:
+        return None
+    for name, value in params.items():
+        if value.find('__HASH__') != -1:
+            values[name] = None
+        elif values.get(name, { '' }) != None:
+            values.setdefault(name, { '' }).add(value)
+    return values
+
+def reachabledefinitions(tree, defs, params=None):
+    templatenames = set()
+    inputeventids = set()
+    # Iterate until no more templates or input events are found, as
+    # newly reachable ones can provide more parameter values for
+    # dynamically named calls.
+    while True:
+        elems = [ tree ]
+        elems += [defs['templates'][name] for name in templatenames]
+        elems += [defs['inputevents'][id] for id in inputeventids]
+        values = collectparamvalues(elems)
+        if params != None:
+            # The templates called also see the parameters of the caller
+            values = addparamvalues(values, params)
+        newtemplatenames = set()
+        newinputeventids = set()
+        reachablenames(elems, 'UseTemplate', 'Name', defs['templates'], values, newtemplatenames)
+        reachablenames(elems, 'UseInputEvent', 'ID', defs['inputevents'], values, newinputeventids)
+        if newtemplatenames <= templatenames and newinputeventids <= inputeventids:
+            break
+        templatenames |= newtemplatenames
+        inputeventids |= newinputeventids
+    return templatenames, inputeventids
+
+def linksnapshot(tree):
+    defs = { 'files': { }, 'templates': { }, 'inputevents': { }, 'other': [ ] }
+    defs['files'][os.path.abspath(args.input)] = os.stat(args.input).st_mtime_ns
+    collectdefinitions(tree, args.input, False, defs)
+    if len(defs['other']) > 0:
+        message = 'Can not link, "' + defs['other'][0] + '" contains something else than definitions'
+        if args.link:
+            fatal(message)
+        print(message, file=sys.stderr)
+        return None
+    templatenames, inputeventids = reachabledefinitions(tree, defs)
+    verbose(0, 'Linked ' + str(len(templatenames)) + ' of ' + str(len(defs['templates'])) + ' templates and '
+            + str(len(inputeventids)) + ' of ' + str(len(defs['inputevents'])) + ' input events from '
+            + str(len(defs['files'])) + ' files')
+    # How the includes resolve can change when files are added to or
+    # renamed in the include root, so check its directories, too.
+    root = cleanpathname(os.path.abspath(includedir))
+    return { 'version': SNAPSHOTVERSION,
+             'input': os.path.abspath(args.input),
+             'includedir': os.path.abspath(includedir),
+             'includedirs': includeindex(root)['dirs'],
+             'files': defs['files'],
+             'resolvedincludes': resolvedincludes,
+             'templates': [defs['templates'][name] for name in defs['templates'] if name in templatenames],
+             'inputevents': [defs['inputevents'][id] for id in defs['inputevents'] if id in inputeventids] }
+
+def loadsnapshot(snapshotfile):
+    try:
+        with open(snapshotfile, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return None
+    if not isinstance(snapshot, dict) \
+       or snapshot.get('version') != SNAPSHOTVERSION \
+       or snapshot.get('input') != os.path.abspath(args.input) \
+       or snapshot.get('includedir') != os.path.abspath(includedir):
+        return None
+    for file, mtime in snapshot['files'].items():
+        try:
+            if os.stat(file).st_mtime_ns != mtime:
+                verbose(0, 'Snapshot "' + snapshotfile + '" is out of date because of "' + file + '"')
+                return None
+        except OSError:
+            return None
+    if not includedirsunchanged(cleanpathname(os.path.abspath(includedir)), snapshot['includedirs']):
+        verbose(0, 'Snapshot "' + snapshotfile + '" is out of date because of changes in "' + includedir + '"')
+        return None
+    verbose(0, 'Loaded snapshot "' + snapshotfile + '"')
+    return snapshot
+
+def savesnapshot(snapshot, snapshotfile):
+    with open(snapshotfile, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+
+def usesnapshot(snapshot):
+    for file in snapshot['files']:
+        if file != os.path.abspath(args.input):
+            included[file] = True
+    resolvedincludes.update(snapshot['resolvedincludes'])
+    for template in snapshot['templates']:
+        templates[template.get('Name')] = template
+    for inputevent in snapshot['inputevents']:
+        inputevents[inputevent.get('ID')] = inputevent
+
+# Parallel expansion. The top-level Component and UseTemplate elements
+# of a model file are mostly independent of each other. Those that can
+# not define templates or input events or include files, directly or
+# through the templates they call, are left in place when the file is
+# expanded, and expanded afterwards in a pool of processes. Each one
+# sees only the templates that were defined before it in the file, as
+# it would when expanded in order.
+
+DEFININGTAGS = { 'FILE', 'EOF', 'Include', 'Template', 'InputEvent' }
+
+visibletemplates = { }
+
+# Which templates can define something, directly or through the
+# templates they call, keyed by the number of templates defined when
+# that was computed. The dynamically named calls in the templates are
+# matched using all parameter values in the input file and templates.
+dependenttemplates = { }
+
+def isparallelcontainer(intemplate, elem):
+    if intemplate:
+        return False
+    if elem is tree:
+        return True
+    for container in parallelcontainers:
+        if elem is container:
+            return True
+    return False
+
+def templatedependencies():
+    ndefined = len(templates)
+    if dependenttemplates.get(ndefined) == None:
+        values = collectparamvalues([ tree ] + list(templates.values()))
+        callers = { }
+        dependent = set()
+        for name, template in templates.items():
+            if hasdescendant(template, DEFININGTAGS):
+                dependent.add(name)
+            callees = set()
+            reachablenames([ template ], 'UseTemplate', 'Name', templates, values, callees)
+            for callee in callees:
+                callers.setdefault(callee, set()).add(name)
+        queue = list(dependent)
+        while len(queue) > 0:
+            for caller in callers.get(queue.pop(), set()):
+                if not caller in dependent:
+                    dependent.add(caller)
+                    queue.append(caller)
+        dependenttemplates.clear()
+        dependenttemplates[ndefined] = (values, dependent)
+    return dependenttemplates[ndefined]
+
+def coversvalues(values, unitvalues):
+    if values == None:
+        return True
+    if unitvalues == None:
+        return False
+    for name, candidates in unitvalues.items():
+        if not name in values:
+            return False
+        if values[name] != None and (candidates == None or not candidates <= values[name]):
+            return False
+    return True
+
+def isindependent(unit):
+    if hasdescendant(unit, DEFININGTAGS):
+        return False
+    values, dependent = templatedependencies()
+    if not coversvalues(values, collectparamvalues([ unit ])):
+        # The unit is not from the input file as such, look at
+        # everything reachable from it instead
+        templatenames, inputeventids = reachabledefinitions(unit, { 'templates': templates, 'inputevents': inputevents })
+        for name in templatenames:
+            if hasdescendant(templates[name], DEFININGTAGS):
+                return False
+        return True
+    callees = set()
+    reachablenames([ unit ], 'UseTemplate', 'Name', templates, values, callees)
+    return callees.isdisjoint(dependent)
+
+def expandindependent(job):
+    global templates, deferred
+    # Everything in the worker is expanded in place
+    deferred = None
+    unit, ndefined, file, params = job
+    if ndefined != len(alltemplates):
+        if visibletemplates.get(ndefined) == None:
+            visibletemplates[ndefined] = dict(list(alltemplates.items())[:ndefined])
+        templates = visibletemplates[ndefined]
+    else:
+        templates = alltemplates
+    return list(expandtomany(False, unit, 1, file, params))
+
+def expanddeferred(jobs):
+    global alltemplates
+    alltemplates = templates
+    verbose(0, 'Expanding ' + str(len(deferred)) + ' elements in ' + str(jobs) + ' processes')
+    # The worker processes need the templates defined so far, and
+    # forking is the only way to give them those for free.
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        results = pool.map(expandindependent, [(unit, ndefined, file, params) for container, unit, ndefined, file, params in deferred],
+                           max(1, len(deferred) // (4 * jobs)))
+    expansions = { }
+    containers = [ ]
+    for i in range(len(deferred)):
+        container, unit = deferred[i][0], deferred[i][1]
+        expansions[id(unit)] = results[i]
+        if not container in containers:
+            containers.append(container)
+    for container in containers:
+        kids = [ ]
+        for kid in list(container):
+            if id(kid) in expansions:
+                kids += expansions[id(kid)]
+            else:
+                kids.append(kid)
+        removechildren(container)
+        for kid in kids:
+            container.append(kid)
+
+# Post-processing of the expanded tree. Templates called with the same
+# arguments expand to many structurally identical subtrees. Each
+# subtree is assigned a class number by hash-consing, bottom-up, so
+# that identical subtrees get the same number in linear time.
+# Whitespace-only text does not matter when comparing. The repeated
+# subtrees that are not part of a larger repeated subtree are reported.
+# They can also be factored out into templates in the output, for those
+# that this makes the output smaller.
+
+DEDUPTEMPLATEPREFIX = 'DEDUP_TEMPLATE_'
+
+def significanttext(string):
+    if string == None or string.strip() == '':
+        return None
+    return string
+
+def hashcons(elem, classes, classof, info):
+    kids = [ ]
+    size = 2 * len(elem.tag) + 5
+    eligible = not elem.tag in ACTIVETAGS
+    for kid in elem:
+        cls = hashcons(kid, classes, classof, info)
+        tail = significanttext(kid.tail)
+        kids.append((cls, tail))
+        size += info[cls][1]
+        eligible = eligible and info[cls][2]
+        if tail != None:
+            size += len(tail)
+    text = significanttext(elem.text)
+    if text != None:
+        size += len(text)
+    for key, value in elem.items():
+        size += len(key) + len(value) + 4
+    key = (elem.tag, tuple(sorted(elem.items())), text, tuple(kids))
+    cls = classes.get(key)
+    if cls == None:
+        cls = len(info)
+        classes[key] = cls
+        info.append([0, size, eligible])
+    info[cls][0] += 1
+    classof[id(elem)] = cls
+    return cls
+
+def factoringsaving(count, size):
+    callsize = len('<UseTemplate Name=""/>') + len(DEDUPTEMPLATEPREFIX) + 4
+    return count * size - (size + count * callsize + len('<Template Name=""></Template>') + callsize)
+
+def isworthfactoring(count, size):
+    return factoringsaving(count, size) > 0
+
+def collectoccurrences(elem, classof, info, occurrences, pending):
+    for ix in range(len(elem)):
+        kid = elem[ix]
+        cls = classof[id(kid)]
+        if info[cls][0] > 1:
+            if not cls in occurrences:
+                occurrences[cls] = [ ]
+                heapq.heappush(pending, (-info[cls][1], cls))
+            occurrences[cls].append((elem, ix))
+        else:
+            collectoccurrences(kid, classof, info, occurrences, pending)
+
+def findrepeated(container, classof, info, keep):
+    # Collect the occurrences of repeated subtrees that are not inside
+    # other repeated subtrees. Of those, the classes that keep() rejects,
+    # typically because the other occurrences are inside larger
+    # repeated subtrees, are looked into instead. Going from the largest
+    # to the smallest ensures that a class does not get more occurrences
+    # after it has been decided on.
+    occurrences = { }
+    pending = [ ]
+    collectoccurrences(container, classof, info, occurrences, pending)
+    while len(pending) > 0:
+        size, cls = heapq.heappop(pending)
+        if keep(cls, len(occurrences[cls])):
+            continue
+        for parent, ix in occurrences.pop(cls):
+            collectoccurrences(parent[ix], classof, info, occurrences, pending)
+    return occurrences
+
+def dedupcontainer(tree):
+    for kid in tree:
+        if kid.tag == 'Behaviors':
+            return kid
+    return tree
+
+def dedup(tree, factor):
+    container = dedupcontainer(tree)
+    classof = { }
+    info = [ ]
+    hashcons(container, { }, classof, info)
+    occurrences = findrepeated(container, classof, info, lambda cls, count: count > 1)
+    repeated = list(occurrences)
+    repeated.sort(key=lambda cls: (len(occurrences[cls]) - 1) * info[cls][1], reverse=True)
+    print('Found ' + str(len(repeated)) + ' repeated subtrees', file=sys.stderr)
+    for cls in repeated:
+        parent, ix = occurrences[cls][0]
+        print('    ' + str(len(occurrences[cls])) + ' x ' + str(info[cls][1]) + ' bytes: '
+              + treetostring(1, True, parent[ix]), file=sys.stderr)
+    occurrences = findrepeated(container, classof, info,
+                               lambda cls, count: count > 1 and info[cls][2] and isworthfactoring(count, info[cls][1]))
+    saving = 0
+    for cls in occurrences:
+        saving += factoringsaving(len(occurrences[cls]), info[cls][1])
+    print('Factoring ' + str(len(occurrences)) + ' subtrees into templates saves about ' + str(saving) + ' characters',
+          file=sys.stderr)
+    if not factor:
+        return
+    # Each definition is indented like the first child of the container
+    indent = container.text
+    if indent == None:
+        indent = '\n'
+    definitions = [ ]
+    for cls in occurrences:
+        name = DEDUPTEMPLATEPREFIX + str(len(definitions) + 1)
+        template = ET.Element('Template', { 'Name': name })
+        template.text = indent + '  '
+        template.tail = indent
+        for parent, ix in occurrences[cls]:
+            kid = parent[ix]
+            if len(template) == 0:
+                body = shallowcopyelement(kid)
+                body.tail = indent
+                template.append(body)
+            call = ET.Element('UseTemplate', { 'Name': name })
+            call.tail = kid.tail
+            parent[ix] = call
+        definitions.append(template)
+    for ix in range(len(definitions)):
+        container.insert(ix, definitions[ix])
+
+def compact(elem):
+    elem.text = significanttext(elem.text)
+    elem.tail = significanttext(elem.tail)
+    for kid in elem:
+        compact(kid)
+
+def outputsize(tree):
+    return len(ET.tostring(tree, encoding='unicode')) + 1
+
 # Load the input file
 tree = parse(args.input)
 
+if args.snapshot:
+    snapshot = None
+    if not args.link:
+        snapshot = loadsnapshot(args.snapshot)
+    if snapshot == None:
+        snapshot = linksnapshot(tree)
+        if snapshot != None:
+            savesnapshot(snapshot, args.snapshot)
+    if args.link:
+        sys.exit(0)
+    if snapshot != None:
+        usesnapshot(snapshot)
+
+if args.jobs > 1:
+    if 'fork' in multiprocessing.get_all_start_methods():
+        deferred = [ ]
+    else:
+        verbose(0, 'No parallel expansion on this platform')
+
 # Do the actual work, 
 expand(False, tree, 0, args.input, { })
 
+if deferred:
+    expanddeferred(args.jobs)
+
+if args.factor or args.compact:
+    originalsize = outputsize(tree)
+
+if args.dedup or args.factor:
+    dedup(tree, args.factor)
+
+if args.compact:
+    compact(tree)
+
+if args.factor or args.compact:
+    size = outputsize(tree)
+    print('Output size ' + str(originalsize) + ' -> ' + str(size) + ' characters ('
+          + str(round(100 * (originalsize - size) / originalsize, 1)) + '% smaller)', file=sys.stderr)
+
 ET.ElementTree(tree).write(sys.stdout, encoding='Unicode')
 sys.stdout.write('\n')
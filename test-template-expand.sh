@@ -0,0 +1,30 @@
+#!/bin/sh
+
+# Check that the optional ways to run template-expand.py give the same
+# output as a plain run on the samples that exercise them.
+
+cd "$(dirname "$0")"
+
+tmp=$(mktemp -d)
+trap 'rm -rf "$tmp"' EXIT
+status=0
+
+check() {
+    if ! python3 template-expand.py "$@" > "$tmp/out" 2> "$tmp/err" || ! cmp -s "$tmp/out" "$expected"; then
+	echo "FAIL: template-expand.py $*" >&2
+	cat "$tmp/err" >&2
+	diff "$expected" "$tmp/out" >&2
+	status=1
+    fi
+}
+
+for input in dynamic.xml; do
+    expected=${input%.xml}.out.xml
+    check "$input"
+    check -j 2 "$input"
+    # Build a snapshot, then load it
+    check --snapshot "$tmp/snapshot" "$input"
+    check --snapshot "$tmp/snapshot" "$input"
+done
+
+exit $status